@@ -1,12 +1,97 @@
 from ca_counties import california_counties
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time as datetime_time, timedelta
 import dateutil.tz
 import json
 import requests
+import statistics
+import sys
+import threading
+import time
+from urllib.parse import urlparse
 
 
 PACIFIC_TIME = dateutil.tz.gettz('America/Los_Angeles')
 
+# Seconds to wait for a server to respond before giving up on a request.
+REQUEST_TIMEOUT = 60
+
+# Per-host limits on simultaneous requests and requests per second. Hosts not
+# listed here use the ``default`` entry.
+HOST_LIMITS = {
+    'public.tableau.com': {'concurrency': 2, 'requests_per_second': 2},
+    'files.covid19.ca.gov': {'concurrency': 8, 'requests_per_second': 20},
+    'default': {'concurrency': 4, 'requests_per_second': 5},
+}
+
+# URL templates for the JSON files with stats by category (age, ethnicity,
+# gender). ``{location}`` is replaced with a county key or ``california``.
+GROUPING_URLS = {
+    'race_ethnicity': 'https://files.covid19.ca.gov/data/vaccine-equity/race-ethnicity/vaccines_by_race_ethnicity_{location}.json',
+    'age': 'https://files.covid19.ca.gov/data/vaccine-equity/age/vaccines_by_age_{location}.json',
+    'gender': 'https://files.covid19.ca.gov/data/vaccine-equity/gender/vaccines_by_gender_{location}.json',
+}
+
+
+class HostLimiter:
+    """
+    Limit how many requests to a single host can be in flight at once and how
+    quickly new ones can start. Use as a context manager around each request.
+    """
+    def __init__(self, concurrency, requests_per_second):
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.interval = 1 / requests_per_second
+        self.lock = threading.Lock()
+        self.next_start = 0
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+        return self
+
+    def __exit__(self, *args):
+        self.semaphore.release()
+
+
+_host_limiters = {}
+_host_limiters_lock = threading.Lock()
+_local = threading.local()
+
+
+def limiter_for_url(url):
+    host = urlparse(url).hostname
+    with _host_limiters_lock:
+        if host not in _host_limiters:
+            limits = HOST_LIMITS.get(host, HOST_LIMITS['default'])
+            _host_limiters[host] = HostLimiter(**limits)
+        return _host_limiters[host]
+
+
+def get_session():
+    """
+    Get a ``requests.Session`` for the current thread, so connections are
+    reused across requests. Sessions are not guaranteed to be thread-safe, so
+    each thread gets its own.
+    """
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def fetch(method, url, session=None, **kwargs):
+    """
+    Make an HTTP request, subject to the rate limits for the URL's host.
+    """
+    session = session or get_session()
+    kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+    with limiter_for_url(url):
+        return session.request(method, url, **kwargs)
+
 
 def parse_tableau_json_stream(raw):
     """
@@ -37,7 +122,7 @@ def parse_tableau_json_stream(raw):
     return chunks
 
 
-def get_tableau_data(view, subview):
+def get_tableau_data(view, subview, sticky_session_key=None, session=None):
     """
     Load the main data powering a Tableau Dashbaord. Returns a list of
     dictionaries with data (the first is usually overall layout and structure,
@@ -73,13 +158,25 @@ def get_tableau_data(view, subview):
     And you'd get the corresponding data by calling this function with:
 
         get_tableau_data('COVID-19VaccineDashboardPublic', 'Vaccine')
+
+    ``sticky_session_key`` is a dict of workbook-specific keys that browsers
+    send when loading the data (``workbookId``, ``dataserverPermissions``,
+    etc.). You can find it in the ``bootstrapSession`` request in your
+    browser's developer tools. If not set, it is left out of the request.
+
+    If ``session`` is not set, this uses the current thread's session (see
+    ``get_session()``), so connections can be reused between calls. Each call
+    still starts a new Tableau session (the ``x-session-id`` and
+    ``bootstrapSession`` requests).
     """
     # Use a session because we want to keep cookies around. The first request
     # sets up cookies and generates a session ID, which is needed for the next
     # request, that actually gets the data.
-    session = requests.Session()
-    dashboard_response = session.get(
+    session = session or get_session()
+    dashboard_response = fetch(
+        'GET',
         f'https://public.tableau.com/interactive/views/{view}/{subview}',
+        session=session,
         params={
             ':embed': 'y',
             ':showVizHome': 'no',
@@ -119,14 +216,8 @@ def get_tableau_data(view, subview):
         'devicePixelRatio': '2',
         'clientRenderPixelLimit': '25000000',
         'allowAutogenWorksheetPhoneLayouts': 'false',
-        'sheet_id': 'Vaccine',
+        'sheet_id': subview,
         'showParams': '{"checkpoint":false,"refresh":false,"refreshUnmodified":false,"unknownParams":":embed_code_version=3&publish=yes"}',
-        'stickySessionKey': ('{"dataserverPermissions":"44136fa355b3678a1146ad16f7e8649e94fb4fc21fe77e8310c060f61caaff8a",'
-                             '"featureFlags":"{\\"MetricsAuthoringBeta\\":false}",'
-                             '"isAuthoring":false,'
-                             '"isOfflineMode":false,'
-                             '"lastUpdatedAt":1613242758888,'
-                             '"workbookId":7221037}'),
         'filterTileSize': '200',
         'locale': 'en_US',
         'language': 'en',
@@ -134,7 +225,9 @@ def get_tableau_data(view, subview):
         ':session_feature_flags': '{}',
         'keychain_version': '1',
     }
-    data_response = session.post(data_url, data=post_data)
+    if sticky_session_key:
+        post_data['stickySessionKey'] = json.dumps(sticky_session_key, separators=(',', ':'))
+    data_response = fetch('POST', data_url, session=session, data=post_data)
 
     # NOTE: it *might* be more correct to use data_response.content, but then
     # we need to do some more fancy footwork with character decoding. In the
@@ -209,12 +302,11 @@ def parse_tableau_value_chart(chart_definition, values_by_type, field_name):
     return data[0][field_name]
 
 
-def get_stats_from_tableau():
+def parse_vaccine_dashboard(data):
     """
-    Get the top-line stats (administered/shipped/delivered) come from a Tableau
-    dashboard.
+    Parse the top-line stats out of the state's vaccine dashboard data (as
+    returned by ``get_tableau_data()``).
     """
-    data = get_tableau_data('COVID-19VaccineDashboardPublicv2', 'Vaccine')
     values_by_type = get_tableau_values(data)
 
     charts = (data[1]
@@ -273,28 +365,213 @@ def reformat_grouping(group_data):
             for group in group_data]
 
 
-def get_groupings_for_location(location):
+def get_groupings_for_location(location, url_templates=GROUPING_URLS):
     """
     Stats by category (age, ethnicity, gender) come from separate JSON files
     at well-known URLs for each county.
     """
-    race_ethnicity_url = f'https://files.covid19.ca.gov/data/vaccine-equity/race-ethnicity/vaccines_by_race_ethnicity_{location}.json'
-    age_url = f'https://files.covid19.ca.gov/data/vaccine-equity/age/vaccines_by_age_{location}.json'
-    gender_url = f'https://files.covid19.ca.gov/data/vaccine-equity/gender/vaccines_by_gender_{location}.json'
+    return parse_groupings(location, fetch_json_files(url_templates, location))
+
+
+def fetch_json_files(url_templates, location):
+    """
+    Load the JSON from each of a dict of URL templates for a given location.
+    Returns a dict with the same keys as ``url_templates``.
+    """
+    return {name: fetch('GET', template.format(location=location)).json()
+            for name, template in url_templates.items()}
 
-    race_ethnicity = requests.get(race_ethnicity_url).json()
-    age = requests.get(age_url).json()
-    gender = requests.get(gender_url).json()
 
+def parse_groupings(location, responses):
     return {
         'region': location,
-        'latest_update': race_ethnicity['meta']['LATEST_ADMIN_DATE'],
-        'race_ethnicity': reformat_grouping(race_ethnicity['data']),
-        'age': reformat_grouping(age['data']),
-        'gender': reformat_grouping(gender['data']),
+        'latest_update': responses['race_ethnicity']['meta']['LATEST_ADMIN_DATE'],
+        'race_ethnicity': reformat_grouping(responses['race_ethnicity']['data']),
+        'age': reformat_grouping(responses['age']['data']),
+        'gender': reformat_grouping(responses['gender']['data']),
     }
 
 
+def merge_state(output, results):
+    """
+    Add the results of a job with ``locations`` to the state-level output.
+    """
+    for result in results.values():
+        output['state'].update(result)
+
+
+def merge_counties(output, results):
+    """
+    Add the results of a job with ``locations`` to the output for each county.
+    """
+    for location, result in results.items():
+        output['counties'].setdefault(location, {}).update(result)
+
+
+def merge_vaccine_dashboard(output, result):
+    """
+    Add the results of ``parse_vaccine_dashboard()`` to the output.
+    """
+    output['state'].update(result['state'])
+    for name in california_counties:
+        county = output['counties'].setdefault(name, {})
+        county['total_administered'] = result['counties'][name]
+
+
+def county_key(name):
+    return name.lower().replace(' ', '_')
+
+
+def run_tableau_task(job, location):
+    return job['parse'](get_tableau_data(job['view'],
+                                         job['subview'],
+                                         job.get('sticky_session_key')))
+
+
+def run_json_task(job, location):
+    return job['parse'](location, fetch_json_files(job['urls'], location))
+
+
+JOB_RUNNERS = {
+    'tableau': run_tableau_task,
+    'json': run_json_task,
+}
+
+# Everything to scrape. Each job has a ``type`` (a key in ``JOB_RUNNERS``),
+# a ``parse`` function for the raw data, a ``merge`` function that adds the
+# parsed results to the output (see ``merge_results()``), and
+# ``expected_seconds``, a rough estimate of how long a single task in the job
+# takes, which is used to start the slowest work first. JSON jobs run one task
+# per entry in ``locations``. Results are merged in the order listed here.
+# Tableau jobs can also have a ``sticky_session_key`` (see
+# ``get_tableau_data()``).
+SCRAPE_JOBS = {
+    'state_groupings': {
+        'type': 'json',
+        'urls': GROUPING_URLS,
+        'locations': ['california'],
+        'parse': parse_groupings,
+        'merge': merge_state,
+        'expected_seconds': 1,
+    },
+    'county_groupings': {
+        'type': 'json',
+        'urls': GROUPING_URLS,
+        'locations': california_counties,
+        'parse': parse_groupings,
+        'merge': merge_counties,
+        'expected_seconds': 1,
+    },
+    'tableau': {
+        'type': 'tableau',
+        'view': 'COVID-19VaccineDashboardPublicv2',
+        'subview': 'Vaccine',
+        'sticky_session_key': {
+            'dataserverPermissions': '44136fa355b3678a1146ad16f7e8649e94fb4fc21fe77e8310c060f61caaff8a',
+            'featureFlags': '{"MetricsAuthoringBeta":false}',
+            'isAuthoring': False,
+            'isOfflineMode': False,
+            'lastUpdatedAt': 1613242758888,
+            'workbookId': 7221037,
+        },
+        'parse': parse_vaccine_dashboard,
+        'merge': merge_vaccine_dashboard,
+        'expected_seconds': 5,
+    },
+}
+
+MAX_WORKERS = 16
+
+# Default for ``run_jobs(report=...)``, so ``sys.stderr`` is looked up when
+# called rather than when this module is imported.
+_STDERR = object()
+
+
+def plan_tasks(jobs):
+    """
+    Expand jobs into a list of ``(job_name, location)`` tasks, with the tasks
+    expected to take longest first. Jobs without ``locations`` have a single
+    task with a location of ``None``.
+    """
+    tasks = [(name, location)
+             for name, job in jobs.items()
+             for location in job.get('locations', [None])]
+    return sorted(tasks, key=lambda task: -jobs[task[0]]['expected_seconds'])
+
+
+def run_jobs(jobs, max_workers=MAX_WORKERS, report=_STDERR, executor=None):
+    """
+    Run all the tasks for a set of jobs concurrently. Returns a dict mapping
+    each job name to its result. Jobs with ``locations`` have a result that is
+    a dict mapping locations to results.
+
+    Timing and throughput for each job are written to ``report`` (stderr by
+    default; pass ``None`` to skip).
+
+    Pass an ``executor`` to reuse its threads (and their sessions) across
+    calls. Otherwise, a new one is created and shut down for this call.
+    """
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return run_jobs(jobs, report=report, executor=executor)
+
+    if report is _STDERR:
+        report = sys.stderr
+
+    timings = {name: [] for name in jobs}
+
+    def run_task(name, location):
+        job = jobs[name]
+        start = time.monotonic()
+        result = JOB_RUNNERS[job['type']](job, location)
+        timings[name].append((start, time.monotonic()))
+        return result
+
+    futures = [(name, location, executor.submit(run_task, name, location))
+               for name, location in plan_tasks(jobs)]
+
+    results = {name: {} for name, job in jobs.items() if 'locations' in job}
+    for name, location, future in futures:
+        if 'locations' in jobs[name]:
+            results[name][location] = future.result()
+        else:
+            results[name] = future.result()
+
+    if report:
+        for name, spans in timings.items():
+            if not spans:
+                print(f'{name}: 0 tasks', file=report)
+                continue
+            elapsed = max(end for _, end in spans) - min(start for start, _ in spans)
+            rate = len(spans) / elapsed if elapsed else float('inf')
+            print(f'{name}: {len(spans)} tasks in {elapsed:.2f}s ({rate:.1f} tasks/s)',
+                  file=report)
+
+    return results
+
+
+def merge_results(jobs, results):
+    """
+    Combine the results of ``run_jobs()`` into a single dict with ``state`` and
+    ``counties`` keys, using each job's ``merge`` function.
+    """
+    output = {'state': {}, 'counties': {}}
+    for name, job in jobs.items():
+        if 'merge' not in job:
+            raise ValueError(f'Scrape job "{name}" has no "merge" function, '
+                             f'so its results would be dropped.')
+        job['merge'](output, results[name])
+    return output
+
+
+def get_stats_from_tableau():
+    """
+    Get the top-line stats (administered/shipped/delivered) come from a Tableau
+    dashboard.
+    """
+    return run_tableau_task(SCRAPE_JOBS['tableau'], None)
+
+
 def get_groupings():
     return {
         'state': get_groupings_for_location('california'),
@@ -303,22 +580,19 @@ def get_groupings():
     }
 
 
-def county_key(name):
-    return name.lower().replace(' ', '_')
-
-
-def cli():
-    tableau = get_stats_from_tableau()
-    groups = get_groupings()
+def get_snapshot(executor=None):
+    """
+    Scrape everything in ``SCRAPE_JOBS`` and combine it into a single snapshot
+    of the current data.
+    """
+    return build_snapshot(run_jobs(SCRAPE_JOBS, executor=executor))
 
-    state = groups['state'].copy()
-    state.update(tableau['state'])
 
-    counties = {}
-    for name in california_counties:
-        county = groups['counties'][name].copy()
-        county['total_administered'] = tableau['counties'][name]
-        counties[name] = county
+def build_snapshot(results):
+    """
+    Combine the results of running ``SCRAPE_JOBS`` into a single snapshot.
+    """
+    output = merge_results(SCRAPE_JOBS, results)
 
     # TODO: there should probably be some work done to verify that the last
     # updated dates for all the various data sources match and use those dates
@@ -336,11 +610,215 @@ def cli():
     # whether "11:59pm" is simply hard-coded.
     result = {
         'date': datetime.now(tz=PACIFIC_TIME).date().isoformat(),
-        'state': state,
-        'counties': counties
+        'state': output['state'],
+        'counties': output['counties']
     }
 
-    print(json.dumps(result))
+    return result
+
+
+# Watch mode polls a single small file for changes, and only scrapes
+# everything when it changes.
+WATCH_URL = GROUPING_URLS['race_ethnicity'].format(location='california')
+# Rough guess at when new data is usually published (Pacific time). Once watch
+# mode sees a few publishes, it uses the median of those times instead.
+WATCH_PUBLISH_TIME = datetime_time(hour=12)
+# Poll as often as WATCH_MIN_INTERVAL within WATCH_WINDOW of the expected
+# publish time, and back off to as little as WATCH_MAX_INTERVAL away from it.
+WATCH_WINDOW = timedelta(hours=1)
+WATCH_MIN_INTERVAL = timedelta(minutes=1)
+WATCH_MAX_INTERVAL = timedelta(minutes=30)
+# How many recent publish times to estimate the next one from.
+WATCH_HISTORY_SIZE = 14
+# The state's JSON files and Tableau dashboard don't necessarily update at the
+# same time. When the JSON changes first, watch mode re-checks the Tableau
+# dashboard on each poll, and holds off on writing a snapshot for up to this
+# long so that it doesn't pair new groupings with old totals.
+WATCH_TABLEAU_WAIT = timedelta(hours=3)
+# After writing a snapshot with old Tableau totals, keep re-checking the
+# dashboard for a follow-up until this long after the JSON changed.
+WATCH_TABLEAU_GIVE_UP = timedelta(hours=6)
+# Errors that watch mode logs and retries after, rather than exiting. These
+# are network and HTTP errors, or data that is missing or not in the shape we
+# expect (JSON and Tableau parsing errors are all ValueErrors).
+WATCH_ERRORS = (requests.RequestException, ValueError, KeyError, IndexError, TypeError)
+
+
+class UpdateChecker:
+    """
+    Cheaply check whether a JSON file from the state has new data. Uses
+    conditional requests, so an unchanged file costs an empty 304 response.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.etag = None
+        self.last_modified = None
+        self.latest_update = None
+
+    def check(self):
+        """
+        Returns ``True`` if the file has a new ``LATEST_ADMIN_DATE`` since the
+        last check. The first check always returns ``True``.
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        response = fetch('GET', self.url, headers=headers)
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+        latest_update = response.json()['meta']['LATEST_ADMIN_DATE']
+        changed = latest_update != self.latest_update
+        self.latest_update = latest_update
+        return changed
+
+
+def expected_publish_time(history):
+    """
+    Estimate the time of day new data gets published, based on a list of
+    datetimes when previous publishes were seen.
+    """
+    if not history:
+        return WATCH_PUBLISH_TIME
+
+    # Times of day wrap around at midnight, so measure each one as minutes
+    # before or after the latest publish (within 12 hours) before taking the
+    # median. Otherwise, publishes at 23:50 and 00:10 would average to noon.
+    day = 24 * 60
+    latest = history[-1].hour * 60 + history[-1].minute
+    offsets = [(moment.hour * 60 + moment.minute - latest + day // 2) % day - day // 2
+               for moment in history]
+    minutes = (latest + statistics.median(offsets)) % day
+    return datetime_time(hour=int(minutes // 60), minute=int(minutes % 60))
+
+
+def next_poll_interval(now, history):
+    """
+    Determine how long to wait before polling again. Polls are most frequent
+    near the expected publish time and back off further away from it. Once a
+    day's data has been published, we aim for the next day's publish time.
+    """
+    publish_time = expected_publish_time(history)
+    targets = [datetime.combine(now.date() + timedelta(days=days),
+                                publish_time,
+                                tzinfo=now.tzinfo)
+               for days in (-1, 0, 1)]
+    # Skip targets we've already seen a publish for. Checking yesterday and
+    # tomorrow, too, handles publish times close to midnight.
+    if history:
+        targets = [target for target in targets
+                   if abs(history[-1] - target) >= timedelta(hours=12)]
+
+    distance = min(abs(now - target) for target in targets) - WATCH_WINDOW
+    return min(max(distance / 2, WATCH_MIN_INTERVAL), WATCH_MAX_INTERVAL)
+
+
+def retry_interval(errors):
+    """
+    Determine how long to wait before trying again after ``errors`` failures
+    in a row. Doubles with each failure, up to ``WATCH_MAX_INTERVAL``.
+    """
+    interval = WATCH_MIN_INTERVAL
+    for _ in range(errors - 1):
+        if interval >= WATCH_MAX_INTERVAL:
+            break
+        interval *= 2
+    return min(interval, WATCH_MAX_INTERVAL)
+
+
+def watch():
+    """
+    Run continuously, writing a new snapshot whenever new data is published.
+    The worker threads and their ``requests`` sessions are kept between polls,
+    and the update check runs on them too, so connections get reused while
+    polls are frequent. Servers may close connections during longer gaps,
+    and every Tableau scrape loads a new Tableau session.
+    """
+    checker = UpdateChecker(WATCH_URL)
+    tableau_jobs = {name: job for name, job in SCRAPE_JOBS.items()
+                    if job['type'] == 'tableau'}
+    history = []
+    results = None
+    # Whether ``results`` has new data that hasn't been written yet.
+    unwritten = False
+    # Tableau results that went into the last snapshot written.
+    written_tableau = None
+    # When the JSON last changed, if we are waiting for Tableau to catch up.
+    waiting_since = None
+    # Always scrape on startup.
+    needs_scrape = True
+    errors = 0
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        while True:
+            try:
+                # Once the checker has seen a change, it won't report it
+                # again, so remember it until a scrape actually succeeds.
+                if executor.submit(checker.check).result():
+                    needs_scrape = True
+                    detected_at = datetime.now(tz=PACIFIC_TIME)
+                now = datetime.now(tz=PACIFIC_TIME)
+                if needs_scrape:
+                    results = run_jobs(SCRAPE_JOBS, executor=executor)
+                    needs_scrape = False
+                    unwritten = True
+                    if written_tableau is not None:
+                        history = (history + [detected_at])[-WATCH_HISTORY_SIZE:]
+                        waiting_since = detected_at
+                elif waiting_since and now - waiting_since >= WATCH_TABLEAU_GIVE_UP:
+                    waiting_since = None
+                elif waiting_since:
+                    tableau_results = run_jobs(tableau_jobs, executor=executor)
+                    if any(results[name] != result for name, result in tableau_results.items()):
+                        results.update(tableau_results)
+                        unwritten = True
+
+                tableau = {name: results[name] for name in tableau_jobs}
+                if waiting_since and tableau != written_tableau:
+                    waiting_since = None
+
+                # Only write when there's new data. Snapshots are dated when
+                # they're built, so rebuilding the same results on a later
+                # day would look like a new day's data.
+                if unwritten and (not waiting_since or now - waiting_since >= WATCH_TABLEAU_WAIT):
+                    write_snapshot(build_snapshot(results))
+                    unwritten = False
+                    written_tableau = tableau
+            except WATCH_ERRORS as error:
+                errors += 1
+                interval = retry_interval(errors)
+                print(f'Error while watching for updates (retrying in {interval}): {error!r}',
+                      file=sys.stderr)
+            else:
+                errors = 0
+                interval = next_poll_interval(datetime.now(tz=PACIFIC_TIME), history)
+
+            time.sleep(interval.total_seconds())
+
+
+def write_snapshot(snapshot):
+    print(json.dumps(snapshot), flush=True)
+
+
+USAGE = """Usage: python ca_covid_vaccination_stats.py [watch]
+
+Scrape the current data and write it to stdout as JSON. With `watch`, keep
+running and write a new snapshot each time new data is published."""
+
+
+def cli():
+    arguments = sys.argv[1:]
+    if arguments == []:
+        write_snapshot(get_snapshot())
+    elif arguments == ['watch']:
+        watch()
+    else:
+        sys.exit(USAGE)
 
 
 if __name__ == '__main__':
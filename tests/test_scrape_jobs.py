@@ -0,0 +1,152 @@
+"""
+Tests for scheduling and rate-limiting scrape jobs.
+"""
+import ca_covid_vaccination_stats
+from ca_covid_vaccination_stats import (HostLimiter,
+                                        limiter_for_url,
+                                        merge_results,
+                                        plan_tasks,
+                                        run_jobs,
+                                        run_tableau_task)
+from concurrent.futures import ThreadPoolExecutor
+import io
+import pytest
+import threading
+import time
+from types import SimpleNamespace
+
+
+def test_plan_tasks_starts_slowest_work_first():
+    jobs = {
+        'fast': {'type': 'json', 'locations': ['a', 'b'], 'expected_seconds': 1},
+        'slow': {'type': 'tableau', 'expected_seconds': 5},
+    }
+    assert plan_tasks(jobs) == [('slow', None), ('fast', 'a'), ('fast', 'b')]
+
+
+def test_host_limiter_spaces_out_requests():
+    limiter = HostLimiter(concurrency=4, requests_per_second=20)
+    start = time.monotonic()
+    for _ in range(5):
+        with limiter:
+            pass
+    # The first request starts immediately; the next four wait 0.05s each.
+    assert time.monotonic() - start >= 0.2
+
+
+def test_host_limiter_caps_concurrent_requests():
+    limiter = HostLimiter(concurrency=2, requests_per_second=1000)
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+
+    def request():
+        nonlocal in_flight, max_in_flight
+        with limiter:
+            with lock:
+                in_flight += 1
+                max_in_flight = max(max_in_flight, in_flight)
+            time.sleep(0.02)
+            with lock:
+                in_flight -= 1
+
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        for _ in range(12):
+            executor.submit(request)
+
+    assert max_in_flight == 2
+
+
+def test_limiter_for_url_uses_host_limits(monkeypatch):
+    monkeypatch.setattr(ca_covid_vaccination_stats, '_host_limiters', {})
+    monkeypatch.setattr(ca_covid_vaccination_stats, 'HOST_LIMITS', {
+        'listed.example.com': {'concurrency': 3, 'requests_per_second': 10},
+        'default': {'concurrency': 1, 'requests_per_second': 4},
+    })
+    listed = limiter_for_url('https://listed.example.com/a.json')
+    assert listed.interval == 0.1
+    assert limiter_for_url('https://listed.example.com/b.json') is listed
+
+    unlisted = limiter_for_url('https://unlisted.example.com/a.json')
+    assert unlisted is not listed
+    assert unlisted.interval == 0.25
+    # Only one request at a time is allowed under the default limits.
+    assert unlisted.semaphore.acquire(blocking=False)
+    assert not unlisted.semaphore.acquire(blocking=False)
+
+
+def test_run_jobs(monkeypatch):
+    monkeypatch.setitem(ca_covid_vaccination_stats.JOB_RUNNERS,
+                        'fake',
+                        lambda job, location: (job['value'], location))
+    jobs = {
+        'single': {'type': 'fake', 'value': 1, 'expected_seconds': 2},
+        'multiple': {'type': 'fake', 'value': 2, 'locations': ['a', 'b'], 'expected_seconds': 1},
+    }
+    report = io.StringIO()
+    results = run_jobs(jobs, report=report)
+    assert results == {
+        'single': (1, None),
+        'multiple': {'a': (2, 'a'), 'b': (2, 'b')},
+    }
+    assert 'single: 1 tasks' in report.getvalue()
+    assert 'multiple: 2 tasks' in report.getvalue()
+
+
+def test_run_tableau_task_sends_job_session_key(monkeypatch):
+    requests = []
+
+    def fake_fetch(method, url, **kwargs):
+        requests.append(kwargs)
+        return SimpleNamespace(headers={'x-session-id': 'abc'}, text='')
+
+    monkeypatch.setattr(ca_covid_vaccination_stats, 'fetch', fake_fetch)
+    job = {
+        'type': 'tableau',
+        'view': 'SomeView',
+        'subview': 'SomeSheet',
+        'sticky_session_key': {'workbookId': 123, 'isAuthoring': False},
+        'parse': lambda data: data,
+    }
+    run_tableau_task(job, None)
+    post_data = requests[1]['data']
+    assert post_data['sheet_id'] == 'SomeSheet'
+    assert post_data['stickySessionKey'] == '{"workbookId":123,"isAuthoring":false}'
+
+
+def test_run_jobs_reports_jobs_with_no_locations():
+    report = io.StringIO()
+    results = run_jobs({'empty': {'type': 'json', 'locations': [], 'expected_seconds': 1}},
+                       report=report)
+    assert results == {'empty': {}}
+    assert report.getvalue() == 'empty: 0 tasks\n'
+
+
+def test_run_jobs_reports_to_current_stderr(monkeypatch, capsys):
+    monkeypatch.setitem(ca_covid_vaccination_stats.JOB_RUNNERS,
+                        'fake',
+                        lambda job, location: None)
+    run_jobs({'single': {'type': 'fake', 'expected_seconds': 1}})
+    assert 'single: 1 tasks' in capsys.readouterr().err
+
+
+def test_merge_results():
+    jobs = {
+        'state': {'merge': ca_covid_vaccination_stats.merge_state},
+        'counties': {'merge': ca_covid_vaccination_stats.merge_counties},
+        'extra': {'merge': lambda output, result: output['state'].update(extra=result)},
+    }
+    results = {
+        'state': {'california': {'region': 'california'}},
+        'counties': {'alameda': {'region': 'alameda'}},
+        'extra': 5,
+    }
+    assert merge_results(jobs, results) == {
+        'state': {'region': 'california', 'extra': 5},
+        'counties': {'alameda': {'region': 'alameda'}},
+    }
+
+
+def test_merge_results_fails_without_merge_function():
+    with pytest.raises(ValueError, match='"unmerged"'):
+        merge_results({'unmerged': {'type': 'json'}}, {'unmerged': {}})
@@ -0,0 +1,302 @@
+"""
+Tests for checking for updates and scheduling polls in watch mode.
+"""
+import ca_covid_vaccination_stats
+from ca_covid_vaccination_stats import (PACIFIC_TIME,
+                                        UpdateChecker,
+                                        WATCH_MAX_INTERVAL,
+                                        WATCH_MIN_INTERVAL,
+                                        cli,
+                                        expected_publish_time,
+                                        next_poll_interval,
+                                        retry_interval,
+                                        watch)
+from datetime import datetime, time, timedelta
+import itertools
+import pytest
+import requests
+from types import SimpleNamespace
+
+
+def pacific(*args):
+    return datetime(*args, tzinfo=PACIFIC_TIME)
+
+
+def fake_response(status_code=200, latest_update=None, headers=None):
+    return SimpleNamespace(
+        status_code=status_code,
+        headers=headers or {},
+        raise_for_status=lambda: None,
+        json=lambda: {'meta': {'LATEST_ADMIN_DATE': latest_update}, 'data': []}
+    )
+
+
+def stub_fetch(monkeypatch, responses):
+    """
+    Replace ``fetch()`` with one that returns ``responses`` in order. Returns
+    a list that records the headers sent with each request.
+    """
+    responses = iter(responses)
+    sent_headers = []
+
+    def fake_fetch(method, url, headers=None, **kwargs):
+        sent_headers.append(headers)
+        return next(responses)
+
+    monkeypatch.setattr(ca_covid_vaccination_stats, 'fetch', fake_fetch)
+    return sent_headers
+
+
+def test_update_checker_first_check_is_a_change(monkeypatch):
+    stub_fetch(monkeypatch, [fake_response(latest_update='2021-03-01')])
+    assert UpdateChecker('https://example.com/data.json').check()
+
+
+def test_update_checker_sends_conditional_headers(monkeypatch):
+    headers = {'ETag': '"abc"', 'Last-Modified': 'Mon, 01 Mar 2021 18:00:00 GMT'}
+    sent_headers = stub_fetch(monkeypatch, [
+        fake_response(latest_update='2021-03-01', headers=headers),
+        fake_response(status_code=304),
+    ])
+    checker = UpdateChecker('https://example.com/data.json')
+    checker.check()
+    checker.check()
+    assert sent_headers == [{}, {'If-None-Match': '"abc"',
+                                 'If-Modified-Since': 'Mon, 01 Mar 2021 18:00:00 GMT'}]
+
+
+def test_update_checker_not_modified_is_not_a_change(monkeypatch):
+    stub_fetch(monkeypatch, [
+        fake_response(latest_update='2021-03-01', headers={'ETag': '"abc"'}),
+        fake_response(status_code=304),
+    ])
+    checker = UpdateChecker('https://example.com/data.json')
+    assert checker.check()
+    assert not checker.check()
+
+
+def test_update_checker_same_date_is_not_a_change(monkeypatch):
+    stub_fetch(monkeypatch, [
+        fake_response(latest_update='2021-03-01'),
+        fake_response(latest_update='2021-03-01'),
+        fake_response(latest_update='2021-03-02'),
+    ])
+    checker = UpdateChecker('https://example.com/data.json')
+    assert checker.check()
+    assert not checker.check()
+    assert checker.check()
+
+
+def test_expected_publish_time_uses_median_of_history():
+    history = [pacific(2021, 3, 1, 9, 30),
+               pacific(2021, 3, 2, 10, 0),
+               pacific(2021, 3, 3, 14, 0)]
+    assert expected_publish_time(history) == time(10, 0)
+
+
+def test_next_poll_interval_is_short_near_publish_time():
+    history = [pacific(2021, 3, 1, 10, 0)]
+    interval = next_poll_interval(pacific(2021, 3, 2, 10, 15), history)
+    assert interval == WATCH_MIN_INTERVAL
+
+
+def test_next_poll_interval_backs_off_away_from_publish_time():
+    history = [pacific(2021, 3, 1, 10, 0)]
+    assert next_poll_interval(pacific(2021, 3, 2, 2, 0), history) == WATCH_MAX_INTERVAL
+    # Approaching the window, polls get more frequent without skipping it.
+    interval = next_poll_interval(pacific(2021, 3, 2, 8, 30), history)
+    assert WATCH_MIN_INTERVAL < interval < WATCH_MAX_INTERVAL
+    assert interval <= timedelta(minutes=15)
+
+
+def test_next_poll_interval_backs_off_after_publish():
+    history = [pacific(2021, 3, 1, 10, 0), pacific(2021, 3, 2, 10, 5)]
+    interval = next_poll_interval(pacific(2021, 3, 2, 10, 10), history)
+    assert interval == WATCH_MAX_INTERVAL
+
+
+def test_next_poll_interval_handles_publish_times_near_midnight(monkeypatch):
+    monkeypatch.setattr(ca_covid_vaccination_stats, 'WATCH_PUBLISH_TIME', time(0, 30))
+    interval = next_poll_interval(pacific(2021, 3, 1, 23, 45), [])
+    assert interval == WATCH_MIN_INTERVAL
+
+    # After a publish just past midnight, back off until the next night.
+    history = [pacific(2021, 3, 2, 0, 35)]
+    assert next_poll_interval(pacific(2021, 3, 2, 0, 40), history) == WATCH_MAX_INTERVAL
+    assert next_poll_interval(pacific(2021, 3, 2, 23, 45), history) == WATCH_MIN_INTERVAL
+
+
+def test_expected_publish_time_handles_publishes_on_both_sides_of_midnight():
+    history = [pacific(2021, 3, 1, 23, 50), pacific(2021, 3, 3, 0, 10)]
+    assert expected_publish_time(history) == time(0, 0)
+
+    history = [pacific(2021, 3, 1, 23, 40),
+               pacific(2021, 3, 3, 0, 10),
+               pacific(2021, 3, 3, 23, 50)]
+    assert expected_publish_time(history) == time(23, 50)
+
+
+def test_retry_interval_backs_off():
+    assert retry_interval(1) == WATCH_MIN_INTERVAL
+    assert retry_interval(2) == WATCH_MIN_INTERVAL * 2
+    assert retry_interval(100) == WATCH_MAX_INTERVAL
+
+
+class StopWatching(Exception):
+    pass
+
+
+def run_watch(monkeypatch, checks, tableau_values, polls, start=None,
+              build_snapshot=dict):
+    """
+    Run ``watch()`` for ``polls`` polls with stubbed-out requests. ``checks``
+    are the results of each ``UpdateChecker.check()`` call (exceptions are
+    raised), and ``tableau_values`` are the results of each Tableau scrape.
+    If ``start`` is set, the clock starts then and only moves when sleeping.
+
+    Returns the sleep intervals, the snapshots that were written, and the
+    times of any Tableau-only scrapes.
+    """
+    checks = iter(checks)
+    tableau_values = iter(tableau_values)
+    full_scrapes = 0
+    clock = [start]
+    tableau_scrapes = []
+
+    class FakeDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return clock[0]
+
+    def fake_check(self):
+        result = next(checks)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def fake_run_jobs(jobs, executor=None):
+        nonlocal full_scrapes
+        if 'state_groupings' in jobs:
+            full_scrapes += 1
+        else:
+            tableau_scrapes.append(clock[0])
+        return {name: next(tableau_values) if name == 'tableau' else full_scrapes
+                for name in jobs}
+
+    sleeps = []
+
+    def fake_sleep(seconds):
+        sleeps.append(seconds)
+        if start:
+            clock[0] += timedelta(seconds=seconds)
+        if len(sleeps) == polls:
+            raise StopWatching()
+
+    written = []
+    monkeypatch.setattr(ca_covid_vaccination_stats.UpdateChecker, 'check', fake_check)
+    monkeypatch.setattr(ca_covid_vaccination_stats, 'run_jobs', fake_run_jobs)
+    monkeypatch.setattr(ca_covid_vaccination_stats, 'build_snapshot', build_snapshot)
+    monkeypatch.setattr(ca_covid_vaccination_stats, 'write_snapshot', written.append)
+    monkeypatch.setattr(ca_covid_vaccination_stats.time, 'sleep', fake_sleep)
+    if start:
+        monkeypatch.setattr(ca_covid_vaccination_stats, 'datetime', FakeDatetime)
+    with pytest.raises(StopWatching):
+        watch()
+
+    return SimpleNamespace(sleeps=sleeps, written=written, tableau_scrapes=tableau_scrapes)
+
+
+def test_watch_retries_after_errors(monkeypatch, capsys):
+    run = run_watch(monkeypatch,
+                    checks=[requests.ConnectionError('offline'), True],
+                    tableau_values=[1],
+                    polls=2)
+    assert 'offline' in capsys.readouterr().err
+    assert run.sleeps[0] == WATCH_MIN_INTERVAL.total_seconds()
+    assert len(run.written) == 1
+
+
+def test_watch_waits_for_tableau_to_update(monkeypatch):
+    run = run_watch(monkeypatch,
+                    checks=[True, True, False, False],
+                    tableau_values=[1, 1, 1, 2],
+                    polls=4)
+    assert [snapshot['tableau'] for snapshot in run.written] == [1, 2]
+    assert [snapshot['state_groupings'] for snapshot in run.written] == [1, 2]
+
+
+def test_watch_records_publish_time_before_scraping(monkeypatch):
+    # Each call to now() is a minute later than the last.
+    moments = (pacific(2021, 3, 1, 10, minute) for minute in range(60))
+    history = []
+
+    class FakeDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return next(moments)
+
+    def fake_next_poll_interval(now, watch_history):
+        history[:] = watch_history
+        return WATCH_MIN_INTERVAL
+
+    monkeypatch.setattr(ca_covid_vaccination_stats, 'datetime', FakeDatetime)
+    monkeypatch.setattr(ca_covid_vaccination_stats, 'next_poll_interval', fake_next_poll_interval)
+    run_watch(monkeypatch, checks=[True, True], tableau_values=[1, 2], polls=2)
+    # Startup uses 10:00-10:02. The second check sees a change at 10:03, and
+    # the scrape finishes at 10:04.
+    assert history == [pacific(2021, 3, 1, 10, 3)]
+
+
+def test_watch_stops_waiting_for_tableau_eventually(monkeypatch):
+    monkeypatch.setattr(ca_covid_vaccination_stats, 'WATCH_TABLEAU_WAIT', timedelta(0))
+    run = run_watch(monkeypatch,
+                    checks=[True, True, False],
+                    tableau_values=[1, 1, 2],
+                    polls=3)
+    assert [(snapshot['state_groupings'], snapshot['tableau']) for snapshot in run.written] == [
+        (1, 1),
+        (2, 1),
+        # Tableau updates later get a follow-up snapshot.
+        (2, 2),
+    ]
+
+
+def test_watch_stops_checking_tableau_after_giving_up(monkeypatch):
+    start = pacific(2021, 3, 1, 9, 0)
+    run = run_watch(monkeypatch,
+                    checks=[True, True] + [False] * 40,
+                    tableau_values=itertools.repeat(1),
+                    polls=40,
+                    start=start)
+    # Startup, then new groupings with the old totals once the wait is over.
+    assert [(snapshot['state_groupings'], snapshot['tableau']) for snapshot in run.written] == [
+        (1, 1),
+        (2, 1),
+    ]
+    changed_at = start + timedelta(seconds=run.sleeps[0])
+    assert run.tableau_scrapes
+    assert max(run.tableau_scrapes) < changed_at + ca_covid_vaccination_stats.WATCH_TABLEAU_GIVE_UP
+    assert sum(run.sleeps) > ca_covid_vaccination_stats.WATCH_TABLEAU_GIVE_UP.total_seconds() * 2
+
+
+def test_watch_does_not_rewrite_old_data_after_midnight(monkeypatch):
+    def dated_snapshot(results):
+        return dict(results, date=ca_covid_vaccination_stats.datetime.now().date())
+
+    run = run_watch(monkeypatch,
+                    checks=[True] + [False] * 10,
+                    tableau_values=[1],
+                    polls=10,
+                    start=pacific(2021, 3, 1, 23, 0),
+                    build_snapshot=dated_snapshot)
+    assert [snapshot['date'].isoformat() for snapshot in run.written] == ['2021-03-01']
+
+
+@pytest.mark.parametrize('arguments', [['wtach'], ['watch', '--foo'], ['--help']])
+def test_cli_rejects_unknown_arguments(monkeypatch, capsys, arguments):
+    monkeypatch.setattr(ca_covid_vaccination_stats.sys, 'argv', ['ca_covid_vaccination_stats.py'] + arguments)
+    monkeypatch.setattr(ca_covid_vaccination_stats, 'watch', lambda: pytest.fail('watch() should not run'))
+    monkeypatch.setattr(ca_covid_vaccination_stats, 'get_snapshot', lambda: pytest.fail('get_snapshot() should not run'))
+    with pytest.raises(SystemExit) as error:
+        cli()
+    assert error.value.code.startswith('Usage:')